@@ -1,116 +1,391 @@
 import os
-import sys
-import json
 import logging
 import io
 import random
-from fastapi import FastAPI, Request, HTTPException
-from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
-from linebot.models import (
-    MessageEvent, ImageMessage, TextMessage, TextSendMessage,
-    FlexSendMessage, StickerMessage # スタンプ対応を追加
-)
-import google.generativeai as genai
-from PIL import Image
-from dotenv import load_dotenv
-from a2wsgi import ASGIMiddleware
+import asyncio
+import functools
+import hashlib
+import hmac
+import base64
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import TypedDict
+from urllib.parse import urlencode
+from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
+import httpx
+import orjson
+from PIL import Image, ImageOps
 
-load_dotenv()
+# 本番(Vercel)では環境変数が直接入るので、.envがあるローカル実行時だけdotenvを読む
+# （カレントディレクトリに依存しないよう、このファイルから見たリポジトリ直下の.envを見る）
+DOTENV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".env")
+if os.path.exists(DOTENV_PATH):
+    from dotenv import load_dotenv
+    load_dotenv(DOTENV_PATH)
 
 # --- 設定値 ---
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_MODEL = "gemini-2.5-flash-lite"
+GEMINI_FALLBACK_MODEL = "gemini-2.5-flash"
 AMAZON_ASSOCIATE_TAG = os.getenv("AMAZON_ASSOCIATE_TAG", "dummy-tag-22")
+AMAZON_SEARCH_BASE = "https://www.amazon.co.jp/s?"
+LINE_API_BASE = "https://api.line.me/v2/bot"
+LINE_DATA_API_BASE = "https://api-data.line.me/v2/bot"
 
 # --- 初期化 ---
-_app = FastAPI()
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
-line_handler = WebhookHandler(LINE_CHANNEL_SECRET)
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel('gemini-2.5-flash')
-logging.basicConfig(level=logging.INFO)
+# シークレットが無いと空の鍵で署名を検証することになり、誰でも偽のWebhookを通せてしまうので起動させない
+if not LINE_CHANNEL_SECRET:
+    raise RuntimeError("LINE_CHANNEL_SECRET is not set")
+_channel_secret = LINE_CHANNEL_SECRET.encode("utf-8")
+# LINEへのリクエストは全部このクライアントで非同期に投げる（イベントループを止めない）
+# プールした接続は作ったイベントループに紐づくので、import時ではなく実行中のループで作る。
+# ランタイムが呼び出しごとに別のループを使う場合は、古い接続を使い回さず作り直す。
+_line_http = None
+_line_http_loop = None
+# ウォームアップはプロセスごとに1回だけ（Webhookのたびに余計なAPI呼び出しをしない）
+_warmed_up = False
+
+def _drop_line_http():
+    # 古いループのクライアントを捨てる。ループがまだ動いていればそのループ上で接続を閉じる
+    # （閉じられたループの接続は、ループ終了時にすでに破棄されている）
+    global _line_http, _line_http_loop
+    client, loop = _line_http, _line_http_loop
+    _line_http, _line_http_loop = None, None
+    if client is not None and loop.is_running() and not loop.is_closed():
+        asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+
+def get_line_http():
+    global _line_http, _line_http_loop
+    loop = asyncio.get_running_loop()
+    if _line_http is not None and _line_http_loop is not loop:
+        _drop_line_http()
+    if _line_http is None:
+        _line_http = httpx.AsyncClient(
+            headers={"Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"},
+            timeout=httpx.Timeout(10.0),
+            limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+            http2=True,
+        )
+        _line_http_loop = loop
+    return _line_http
+
+# 固定の指示文はsystem_instructionとして常に先頭に置く（Geminiの暗黙キャッシュが効くように）
+STATIC_PROMPT = """
+あなたは「本の価値を最大化して伝えるプロの書評家」です。
+送られてきた本の表紙から内容を特定し、読者が「この具体的な知識が欲しい！」と強く思うような紹介文を作成してください。
+紹介文は、ユーザーから指定される【選ばれた戦略】に沿って書いてください。
+
+【出力ルール】
+1. 本の中に書かれている「具体的なキーワード」や「ノウハウ」を必ず抽出する。
+2. ただし、すべてを要約するのではなく「ここを知れば人生が変わる」というポイントを3つ抜き出す。
+3. 抽象的な言葉（すごい、やばい）は禁止。具体的な用語を使うこと。
+
+【各項目】
+- title: 正式なタイトル / author: 著者名
+- catchphrase: 戦略に基づいた鋭いキャッチコピー（20文字以内）
+- key_points: 本書で学べる具体的なノウハウを3つ（例：〇〇の法則とは、1日5分でできる〇〇）
+- description: 3つのポイントを踏まえ「なぜ今この本を読む必要があるのか」を論理的に説く文章（120文字程度）。最後は購入リンクへ誘導する言葉で締める
+- search_keyword: Amazon検索用キーワード（タイトル 著者名）
+"""
+# Geminiに返させるJSONの形（response_schemaで強制するので、崩れたJSONは返ってこない）
+class BookAnalysis(TypedDict):
+    title: str
+    author: str
+    catchphrase: str
+    key_points: list[str]
+    description: str
+    search_keyword: str
+
+# 毎回変わるのは戦略の部分だけ（角度, 指示）
+STRATEGIES = (
+    ("【A：裏ロジック】", "常識の逆を行く成功法則として紹介する。"),
+    ("【B：機会損失】", "この知識がないとどれだけ損するかを強調する。"),
+    ("【C：最短ルート】", "遠回りをやめて、この本でショートカットしろと促す。"),
+    ("【D：本質の暴露】", "小手先のテクニックではなく、本質はここにあると断言する。"),
+    ("【E：権威性】", "トップ層はみんなこれを実践している、という比較をする。"),
+)
+STRATEGY_PROMPT = "【選ばれた戦略】: {angle}\n{instruction}"
+
+# google.generativeaiはimportだけで数百msかかるので、画像が来て初めて読み込む
+# （テキストやスタンプへの返信しかしないコンテナでは一度も読み込まない）
+# functools.cacheはロックを取らないので、先読みスレッドと解析側が同時に呼んでも
+# 二重に作らないよう、ロックの中で作る（_modelの中から_genaiを呼ぶのでRLock）
+_genai_lock = threading.RLock()
+
+def _load_once(func):
+    cached = functools.cache(func)
+    @functools.wraps(func)
+    def wrapper():
+        with _genai_lock:
+            return cached()
+    return wrapper
+
+@_load_once
+def _genai():
+    import google.generativeai as genai
+    genai.configure(api_key=GEMINI_API_KEY)
+    return genai
+
+@_load_once
+def _model():
+    return _genai().GenerativeModel(
+        GEMINI_MODEL,
+        system_instruction=STATIC_PROMPT,
+        generation_config={
+            "response_mime_type": "application/json",
+            "response_schema": BookAnalysis,
+            "max_output_tokens": 768,
+        },
+    )
+
+def _preload_model():
+    # 先読みでの失敗は無視する（解析時にもう一度読み込み、そこで失敗すればエラー返信になる）
+    try:
+        _model()
+    except Exception:
+        pass
+
+# 2.5-flashは思考トークンも出力上限に数えられるので、こちらには上限を付けない
+@_load_once
+def _fallback_model():
+    return _genai().GenerativeModel(
+        GEMINI_FALLBACK_MODEL,
+        system_instruction=STATIC_PROMPT,
+        generation_config={"response_mime_type": "application/json", "response_schema": BookAnalysis},
+    )
+
+# ランタイム側ですでにハンドラが設定されていれば、上書きしない
+if not logging.getLogger().hasHandlers():
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s %(message)s")
 logger = logging.getLogger(__name__)
 
-# --- 関数 ---
-def analyze_book_image(image_bytes):
+# --- 解析結果キャッシュ ---
+# 同じ表紙が何度も送られてくるので、Geminiを呼ぶ前にキャッシュを引く。
+# 完全一致はバイト列のblake2b、撮り直し程度の差分は64bitの差分ハッシュ(dHash)で拾う。
+CACHE_PATH = "/tmp/recbook_cache.json"
+CACHE_SIZE = 512
+FUZZY_CACHE_SIZE = 128
+FUZZY_MAX_DISTANCE = 6
+
+# /tmpは誰でも書けるので、pickleではなくJSONで保存する（読み込んでもコードは実行されない）
+# 形式: {"exact": [[blake2bキーのhex, 結果], ...], "fuzzy": [[dHash, 結果], ...]}（古い順）
+def _load_cache():
     try:
-        image = Image.open(io.BytesIO(image_bytes))
-        # ... (中略: 前回と同じ戦略ロジック) ...
-        strategies = [
-            {"angle": "【A：裏ロジック】", "instruction": "常識の逆を行く成功法則として紹介する。"},
-            {"angle": "【B：機会損失】", "instruction": "この知識がないとどれだけ損するかを強調する。"},
-            {"angle": "【C：最短ルート】", "instruction": "遠回りをやめて、この本でショートカットしろと促す。"},
-            {"angle": "【D：本質の暴露】", "instruction": "小手先のテクニックではなく、本質はここにあると断言する。"},
-            {"angle": "【E：権威性】", "instruction": "トップ層はみんなこれを実践している、という比較をする。"}
-        ]
-        selected_strategy = random.choice(strategies)
-
-        prompt = f"""
-        あなたは「本の価値を最大化して伝えるプロの書評家」です。
-        送られてきた本の表紙から内容を特定し、読者が「この具体的な知識が欲しい！」と強く思うような紹介文を作成してください。
-        
-        【選ばれた戦略】: {selected_strategy['angle']}
-        {selected_strategy['instruction']}
-
-        【出力ルール】
-        1. 本の中に書かれている「具体的なキーワード」や「ノウハウ」を必ず抽出する。
-        2. ただし、すべてを要約するのではなく「ここを知れば人生が変わる」というポイントを3つ抜き出す。
-        3. 抽象的な言葉（すごい、やばい）は禁止。具体的な用語を使うこと。
-
-        必ず以下のJSONフォーマットのみを出力してください。
-        {{
-          "title": "正式なタイトル",
-          "author": "著者名",
-          "catchphrase": "20文字以内の、戦略に基づいた鋭いキャッチコピー",
-          "key_points": [
-            "本書で学べる具体的なノウハウ1（例：〇〇の法則とは）",
-            "本書で学べる具体的なノウハウ2（例：1日5分でできる〇〇）",
-            "本書で学べる具体的なノウハウ3（例：失敗しないための〇〇思考）"
-          ],
-          "description": "上記3つのポイントを踏まえ、「なぜ今この本を読む必要があるのか」を論理的に説く文章（120文字程度）。最後は購入リンクへ誘導する言葉で締める。",
-          "search_keyword": "Amazon検索用キーワード（タイトル 著者名）"
-        }}
-        """
-        response = model.generate_content([prompt, image])
-        response_text = response.text.replace("```json", "").replace("```", "").strip()
-        if "{" not in response_text: raise Exception("Not JSON")
-        return json.loads(response_text)
+        with open(CACHE_PATH, "rb") as f:
+            saved = orjson.loads(f.read())
+        exact = OrderedDict((bytes.fromhex(key), data) for key, data in saved["exact"])
+        fuzzy = OrderedDict((int(image_hash), data) for image_hash, data in saved["fuzzy"])
+        return exact, fuzzy
+    except Exception:
+        return OrderedDict(), OrderedDict()
+
+_exact_cache, _fuzzy_cache = _load_cache()
+
+def _write_cache(payload):
+    # 途中で落ちても壊れないよう、一時ファイルに書いてからrenameする
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(CACHE_PATH), prefix="recbook_cache.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, CACHE_PATH)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+# 実行中の保存タスク（参照を持っておかないと、途中でGCされることがある）
+_save_tasks = set()
+
+async def _save_cache():
+    # ウォーム状態のコンテナで再利用できるよう/tmpに書き出す
+    # シリアライズはループ上で（書き込み中に辞書が変わらないように）、ファイル書き込みは別スレッドで行う
+    try:
+        payload = orjson.dumps({
+            "exact": [[key.hex(), data] for key, data in _exact_cache.items()],
+            "fuzzy": [[image_hash, data] for image_hash, data in _fuzzy_cache.items()],
+        })
+        await asyncio.to_thread(_write_cache, payload)
     except Exception as e:
-        logger.error(f"AI Error: {e}")
+        logger.warning("Cache save failed: %r", e)
+
+def _image_hash(image):
+    # 9x8のグレースケールに縮小し、隣り合う画素の明暗から64bitを作る
+    pixels = list(image.convert("L").resize((9, 8), Image.Resampling.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+def _cache_get(key, image_hash=None):
+    if key in _exact_cache:
+        _exact_cache.move_to_end(key)
+        return _exact_cache[key]
+    if image_hash is None:
+        return None
+    # 同じシリーズの表紙は数bitしか違わないことがあるので、最初に見つかったものではなく一番近いものを返す
+    best_hash, best_distance = None, FUZZY_MAX_DISTANCE + 1
+    for cached_hash in _fuzzy_cache:
+        distance = bin(cached_hash ^ image_hash).count("1")
+        if distance < best_distance:
+            best_hash, best_distance = cached_hash, distance
+            if distance == 0:
+                break
+    if best_hash is None:
+        return None
+    _fuzzy_cache.move_to_end(best_hash)
+    return _fuzzy_cache[best_hash]
+
+def _cache_put(key, image_hash, data):
+    _exact_cache[key] = data
+    _exact_cache.move_to_end(key)
+    while len(_exact_cache) > CACHE_SIZE:
+        _exact_cache.popitem(last=False)
+    _fuzzy_cache[image_hash] = data
+    _fuzzy_cache.move_to_end(image_hash)
+    while len(_fuzzy_cache) > FUZZY_CACHE_SIZE:
+        _fuzzy_cache.popitem(last=False)
+
+# --- 関数 ---
+MAX_IMAGE_EDGE = 768
+JPEG_QUALITY = 85
+
+def _prepare_image(image_bytes):
+    # スマホの写真は数MBあるので、Geminiに送る前に長辺768pxのJPEGに縮める（それ以上は送っても無駄）
+    # PILの画像のまま渡すとSDKがロスレスWebPに変換してしまうので、JPEGのバイト列で返す
+    # 戻り値: (JPEGバイト列, 縮小済み画像から取った差分ハッシュ)
+    image = Image.open(io.BytesIO(image_bytes))
+    # JPEGならdraftで縮小しながらデコードし、フル解像度の展開を避ける
+    image.draft("RGB", (MAX_IMAGE_EDGE, MAX_IMAGE_EDGE))
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.Resampling.LANCZOS)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    buf = io.BytesIO()
+    image.save(buf, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    return buf.getvalue(), _image_hash(image)
+
+# 解析中の画像（blake2bキー → 結果を待つFuture）
+_inflight = {}
+
+async def analyze_book_image_async(image_bytes):
+    key = hashlib.blake2b(image_bytes, digest_size=16).digest()
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+    # 同じ画像の解析がすでに走っていれば、Geminiをもう一度呼ばずにその結果を待つ
+    # （別のイベントループで作られたFutureは待てないので、そのときは自分で解析する）
+    loop = asyncio.get_running_loop()
+    pending = _inflight.get(key)
+    if pending is not None and pending.get_loop() is loop:
+        return await asyncio.shield(pending)
+    future = loop.create_future()
+    _inflight[key] = future
+    try:
+        result = await _analyze_book_image(key, image_bytes)
+        future.set_result(result)
+        return result
+    finally:
+        if _inflight.get(key) is future:
+            del _inflight[key]
+        if not future.done():
+            future.set_result(None)
+
+async def _analyze_book_image(key, image_bytes):
+    try:
+        # デコード・縮小・エンコードはCPUを食うので、イベントループを止めないよう別スレッドで行う
+        jpeg_bytes, image_hash = await asyncio.to_thread(_prepare_image, image_bytes)
+        cached = _cache_get(key, image_hash)
+        if cached is not None:
+            _cache_put(key, image_hash, cached)
+            return cached
+        angle, instruction = STRATEGIES[random.randrange(len(STRATEGIES))]
+        prompt = STRATEGY_PROMPT.format(angle=angle, instruction=instruction)
+        contents = [prompt, {"mime_type": "image/jpeg", "data": jpeg_bytes}]
+        # 先読みスレッドが読み込み中ならロックが空くまで待ち、その結果を使う
+        # （先読みが失敗していればここでもう一度読み込み、失敗すれば例外になりエラー返信へ）
+        model = await asyncio.to_thread(_model)
+        response = await model.generate_content_async(contents)
+        try:
+            data = orjson.loads(response.text)
+        except ValueError:
+            # 出力が途中で切れた・空だったときだけ、上位モデルで1回やり直す
+            logger.warning("Lite model returned unparsable output, retrying with fallback model")
+            response = await _fallback_model().generate_content_async(contents)
+            data = orjson.loads(response.text)
+        _cache_put(key, image_hash, data)
+        # ファイルに書くのはGeminiを呼んだ新しい結果のときだけ（似た画像のヒットでは書かない）
+        # 返信を待たせないよう、書き込みは別タスクで行う
+        save_task = asyncio.create_task(_save_cache())
+        _save_tasks.add(save_task)
+        save_task.add_done_callback(_save_tasks.discard)
+        return data
+    except Exception:
+        logger.exception("AI error")
         return None
 
+IMAGE_CHUNK_SIZE = 64 * 1024
+
+async def get_message_content_async(message_id):
+    # 大きな画像も一括で受け取らず、64KBずつ読みながら溜めていく
+    buf = io.BytesIO()
+    async with get_line_http().stream("GET", f"{LINE_DATA_API_BASE}/message/{message_id}/content") as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes(IMAGE_CHUNK_SIZE):
+            buf.write(chunk)
+    return buf.getvalue()
+
+# 返信はSDKのメッセージオブジェクトを経由せず、Messaging APIのJSONをそのまま組み立てて送る
+def create_text_message(text):
+    return {"type": "text", "text": text}
+
+async def reply_message_async(reply_token, message):
+    response = await get_line_http().post(
+        f"{LINE_API_BASE}/message/reply",
+        content=orjson.dumps({"replyToken": reply_token, "messages": [message]}),
+        headers={"Content-Type": "application/json"},
+    )
+    response.raise_for_status()
+
+# --- Flex Message ---
+# 毎回変わるのはタイトル・キャッチコピー・ポイント・説明文・URLだけなので、
+# 固定部分はモジュール読み込み時に1回だけ作って使い回す（中身は書き換えないこと）
+_FLEX_HEADER = {
+    "type": "box", "layout": "vertical", "backgroundColor": "#1A237E",
+    "contents": [
+        { "type": "text", "text": "THE SOLUTION", "weight": "bold", "color": "#FFFFFF", "size": "xxs", "align": "center", "letterSpacing": "2px" },
+        { "type": "text", "text": "本書で手に入る武器", "weight": "bold", "color": "#FFFFFF", "size": "sm", "align": "center", "margin": "xs" }
+    ]
+}
+_FLEX_SEPARATOR = { "type": "separator", "margin": "lg", "color": "#EEEEEE" }
+_FLEX_POINT_ICON = { "type": "text", "text": "✔", "color": "#1A237E", "size": "sm", "flex": 1 }
+_FLEX_HERO_IMAGE_URL = "https://cdn-icons-png.flaticon.com/512/3389/3389081.png"
+
 def create_flex_message(data):
-    # ... (中略: 前回と同じFlex Message作成ロジック) ...
-    import urllib.parse
-    query = urllib.parse.quote(data['search_keyword'])
-    amazon_url = f"https://www.amazon.co.jp/s?k={query}&tag={AMAZON_ASSOCIATE_TAG}"
+    amazon_url = AMAZON_SEARCH_BASE + urlencode({"k": data['search_keyword'], "tag": AMAZON_ASSOCIATE_TAG})
     
-    points_contents = []
-    for point in data['key_points']:
-        points_contents.append({
+    points_contents = [
+        {
             "type": "box",
             "layout": "baseline",
             "spacing": "sm",
             "contents": [
-                { "type": "text", "text": "✔", "color": "#1A237E", "size": "sm", "flex": 1 },
+                _FLEX_POINT_ICON,
                 { "type": "text", "text": point, "color": "#555555", "size": "sm", "flex": 9, "wrap": True }
             ],
             "margin": "md"
-        })
+        }
+        for point in data['key_points']
+    ]
 
     bubble_json = {
         "type": "bubble",
-        "header": { 
-            "type": "box", "layout": "vertical", "backgroundColor": "#1A237E",
-            "contents": [
-                { "type": "text", "text": "THE SOLUTION", "weight": "bold", "color": "#FFFFFF", "size": "xxs", "align": "center", "letterSpacing": "2px" },
-                { "type": "text", "text": "本書で手に入る武器", "weight": "bold", "color": "#FFFFFF", "size": "sm", "align": "center", "margin": "xs" }
-            ]
-        },
+        "header": _FLEX_HEADER,
         "hero": { 
-            "type": "image", "url": "https://cdn-icons-png.flaticon.com/512/3389/3389081.png", 
+            "type": "image", "url": _FLEX_HERO_IMAGE_URL, 
             "size": "xs", "aspectRatio": "1:1", "aspectMode": "cover", 
             "action": {"type": "uri", "uri": amazon_url}, "margin": "md"
         },
@@ -118,10 +393,10 @@ def create_flex_message(data):
             "type": "box", "layout": "vertical", 
             "contents": [
                 { "type": "text", "text": data['title'], "weight": "bold", "size": "lg", "wrap": True, "align": "center", "color": "#1A237E" },
-                { "type": "separator", "margin": "lg", "color": "#EEEEEE" },
+                _FLEX_SEPARATOR,
                 { "type": "text", "text": f"“ {data['catchphrase']} ”", "weight": "bold", "size": "md", "color": "#333333", "wrap": True, "margin": "lg", "align": "center", "style": "italic" },
                 { "type": "box", "layout": "vertical", "margin": "lg", "contents": points_contents },
-                { "type": "separator", "margin": "lg", "color": "#EEEEEE" },
+                _FLEX_SEPARATOR,
                 { "type": "text", "text": data['description'], "size": "xs", "color": "#777777", "wrap": True, "margin": "lg", "lineSpacing": "4px" }
             ] 
         },
@@ -132,59 +407,113 @@ def create_flex_message(data):
             ] 
         }
     }
-    return FlexSendMessage(alt_text=f"【要約】{data['title']}", contents=bubble_json)
+    return {"type": "flex", "altText": f"【要約】{data['title']}", "contents": bubble_json}
 
 # --- エンドポイント ---
-@_app.post("/api/index")
-async def callback(request: Request):
+WARM_UP_TIMEOUT = 3.0
+
+async def warm_up_connections(client):
+    # 最初のWebhookの受信中にLINEへのTLS接続を張っておき、返信時にハンドシェイク待ちをさせない
+    # （Geminiはimport自体を遅延させているので、ここでは触らない）
+    try:
+        await client.get(f"{LINE_API_BASE}/info", timeout=WARM_UP_TIMEOUT)
+    except Exception as e:
+        logger.warning("Warm-up failed: %r", e)
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    # ライフスパンを呼ぶランタイムでは、終了時に接続を閉じる
+    if _line_http is not None and _line_http_loop is asyncio.get_running_loop():
+        await _line_http.aclose()
+
+app = FastAPI(lifespan=lifespan)
+
+@app.post("/api/index")
+async def callback(request: Request, background_tasks: BackgroundTasks):
     signature = request.headers.get("X-Line-Signature", "")
     body = await request.body()
-    try:
-        line_handler.handle(body.decode("utf-8"), signature)
-    except InvalidSignatureError:
+    if not verify_signature(body, signature):
         raise HTTPException(status_code=400, detail="Invalid signature")
+    events = orjson.loads(body).get("events", [])
+    # 署名だけ確認してすぐ200を返す。解析・返信はレスポンス後にバックグラウンドで行う
+    # （待たせるとLINEが再送してきて、Geminiを二重に呼んでしまう）
+    background_tasks.add_task(process_events, events)
     return "OK"
 
+def verify_signature(body, signature):
+    # 受け取ったバイト列のままHMAC-SHA256を取り、定数時間で比較する（decodeしない）
+    digest = hmac.new(_channel_secret, body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest), signature.encode("utf-8"))
+
+async def process_events(events):
+    global _warmed_up
+    jobs = [handle_event(event) for event in events]
+    # プロセスで最初のWebhookなら、画像のダウンロード等と並行して返信先へのTLS接続を張っておく
+    # （ライフスパンが呼ばれないランタイムでも効くように、ここで行う）
+    if not _warmed_up:
+        _warmed_up = True
+        jobs.append(warm_up_connections(get_line_http()))
+    await asyncio.gather(*jobs)
+
+async def handle_event(event):
+    if event.get("type") != "message":
+        return
+    message_handler = MESSAGE_HANDLERS.get(event["message"].get("type"))
+    if message_handler is None:
+        return
+    try:
+        await message_handler(event)
+    except Exception:
+        logger.exception("Reply error")
+
 # ★★★ 改善：テキストが送られた時の処理 ★★★
-@line_handler.add(MessageEvent, message=TextMessage)
-def handle_text_message(event):
+async def handle_text_message(event):
     # ユーザーが何を言っても、使い方をガイドする
-    line_bot_api.reply_message(
-        event.reply_token,
-        TextSendMessage(text="【使い方】\n\n気になっている本の「表紙」の写真を1枚送ってください📸\n\nAIがその本を読むべき理由と、具体的な学びを3つ抽出してプレゼンします。")
+    await reply_message_async(
+        event["replyToken"],
+        create_text_message("【使い方】\n\n気になっている本の「表紙」の写真を1枚送ってください📸\n\nAIがその本を読むべき理由と、具体的な学びを3つ抽出してプレゼンします。")
     )
 
 # ★★★ 改善：スタンプが送られた時もガイドする ★★★
-@line_handler.add(MessageEvent, message=StickerMessage)
-def handle_sticker_message(event):
-    line_bot_api.reply_message(
-        event.reply_token,
-        TextSendMessage(text="スタンプありがとうございます！\n本の写真を送ると、私が全力で解説しますよ📚")
+async def handle_sticker_message(event):
+    await reply_message_async(
+        event["replyToken"],
+        create_text_message("スタンプありがとうございます！\n本の写真を送ると、私が全力で解説しますよ📚")
     )
 
-@line_handler.add(MessageEvent, message=ImageMessage)
-def handle_image_message(event):
-    message_id = event.message.id
-    message_content = line_bot_api.get_message_content(message_id)
-    image_bytes = message_content.content
+async def handle_image_message(event):
+    message_id = event["message"]["id"]
+    # 画像のダウンロード中に、Geminiの読み込み（コンテナで初回だけ重い）を別スレッドで始めておく。
+    # 待ち合わせはしないので、キャッシュに当たった画像は読み込みの完了を待たずに返信できる
+    preload = asyncio.create_task(asyncio.to_thread(_preload_model))
+    try:
+        image_bytes = await get_message_content_async(message_id)
     
-    # ユーザーに「解析中...」と伝える（簡易的）
-    # ※Pushメッセージは有料になるリスクがあるので、ReplyTokenを使う必要があるが
-    # LINEの仕様上、1つのReplyTokenで1回しか返信できない。
-    # なので、ここはあえて「待たせる」か、もしくはLoading Animationを使う（高度な実装）。
-    # 今回はシンプルに、解析失敗時だけ丁寧に返すようにします。
+        # ユーザーに「解析中...」と伝える（簡易的）
+        # ※Pushメッセージは有料になるリスクがあるので、ReplyTokenを使う必要があるが
+        # LINEの仕様上、1つのReplyTokenで1回しか返信できない。
+        # なので、ここはあえて「待たせる」か、もしくはLoading Animationを使う（高度な実装）。
+        # 今回はシンプルに、解析失敗時だけ丁寧に返すようにします。
 
-    book_data = analyze_book_image(image_bytes)
+        book_data = await analyze_book_image_async(image_bytes)
     
-    if not book_data:
-        # ★★★ 改善：解析失敗時のメッセージを丁寧に ★★★
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="すみません、うまく読み取れませんでした...💦\n\n・光が反射していないか\n・ブレていないか\n\nを確認して、もう一度正面から撮影してください🙇‍♂️")
-        )
-        return
+        if not book_data:
+            # ★★★ 改善：解析失敗時のメッセージを丁寧に ★★★
+            await reply_message_async(
+                event["replyToken"],
+                create_text_message("すみません、うまく読み取れませんでした...💦\n\n・光が反射していないか\n・ブレていないか\n\nを確認して、もう一度正面から撮影してください🙇‍♂️")
+            )
+            return
 
-    flex_message = create_flex_message(book_data)
-    line_bot_api.reply_message(event.reply_token, flex_message)
+        flex_message = create_flex_message(book_data)
+        await reply_message_async(event["replyToken"], flex_message)
+    finally:
+        # 先読みの終了を待つだけ（失敗は_preload_modelの中で無視しているので、ここで例外にはならない）
+        await preload
 
-app = ASGIMiddleware(_app)
\ No newline at end of file
+MESSAGE_HANDLERS = {
+    "text": handle_text_message,
+    "sticker": handle_sticker_message, # スタンプ対応を追加
+    "image": handle_image_message,
+}
\ No newline at end of file